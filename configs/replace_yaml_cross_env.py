@@ -1,18 +1,40 @@
 #!/usr/bin/env python3
 import sys, argparse, re, yaml, os
 
+DOMAIN = "orangehealth.dev"
+
+# libyaml-backed loader/dumper; PyYAML without libyaml parses in pure Python
+if yaml.__with_libyaml__:
+    YamlLoader, YamlDumper = yaml.CSafeLoader, yaml.CSafeDumper
+else:
+    print("⚠️ PyYAML built without libyaml, using the slow pure-Python parser "
+          "(reinstall PyYAML with libyaml available)", file=sys.stderr)
+    YamlLoader, YamlDumper = yaml.SafeLoader, yaml.SafeDumper
+
+def prefix_substituter(old_prefix, new_prefix):
+    # compiled once per run; returns (new_value, count) in a single pass
+    pattern = re.compile(re.escape(f"{old_prefix}-"))
+    replacement = f"{new_prefix}-".replace("\\", "\\\\")
+
+    def substitute(value):
+        if DOMAIN not in value:
+            return value, 0
+        return pattern.subn(replacement, value)
+
+    return substitute
+
 def replace_in_text(base_file, target_file, old_prefix, new_prefix, show_only):
     with open(target_file, "r") as f:
         lines = f.readlines()
 
+    substitute = prefix_substituter(old_prefix, new_prefix)
     changes = []
     new_lines = []
     for line in lines:
-        if "orangehealth.dev" in line and f"{old_prefix}-" in line:
-            new_line = line.replace(f"{old_prefix}-", f"{new_prefix}-")
-            if new_line != line:
-                changes.append((line.strip(), new_line.strip()))
-                line = new_line
+        new_line, count = substitute(line)
+        if count and new_line != line:
+            changes.append((line.strip(), new_line.strip()))
+            line = new_line
         new_lines.append(line)
 
     if changes:
@@ -26,27 +48,48 @@ def replace_in_text(base_file, target_file, old_prefix, new_prefix, show_only):
 
 def replace_in_yaml(base_file, target_file, old_prefix, new_prefix, show_only):
     with open(target_file, "r") as f:
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=YamlLoader)
 
+    substitute = prefix_substituter(old_prefix, new_prefix)
+    changes = 0
+
+    def sub(value):
+        nonlocal changes
+        new_val, count = substitute(value)
+        if count and new_val != value:
+            print(f"old: {value}\nnew: {new_val}\n")
+            changes += 1
+        return new_val
+
+    # in place: only matched strings are reassigned, no containers rebuilt
     def traverse(node):
         if isinstance(node, dict):
-            for k, v in node.items():
-                node[k] = traverse(v)
+            items = node.items()
         elif isinstance(node, list):
-            return [traverse(v) for v in node]
-        elif isinstance(node, str):
-            if "orangehealth.dev" in node and f"{old_prefix}-" in node:
-                new_val = node.replace(f"{old_prefix}-", f"{new_prefix}-")
-                if new_val != node:
-                    print(f"old: {node}\nnew: {new_val}\n")
-                return new_val
-        return node
+            items = enumerate(node)
+        else:
+            return
+        for k, v in items:
+            if isinstance(v, str):
+                new_val = sub(v)
+                if new_val != v:
+                    node[k] = new_val
+            else:
+                traverse(v)
 
-    updated = traverse(data)
+    if isinstance(data, str):
+        data = sub(data)
+    else:
+        traverse(data)
+
+    # nothing matched → leave the file (and its mtime) alone
+    if not changes:
+        print("ℹ️ No changes detected.")
+        return
 
     if not show_only:
         with open(target_file, "w") as f:
-            yaml.dump(updated, f, default_flow_style=False)
+            yaml.dump(data, f, Dumper=YamlDumper, default_flow_style=False)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -8,7 +8,7 @@ set -euo pipefail
 #  WHAT THIS SCRIPT DOES
 #  ------------------------------------------------------------
 #  • Fetches ALL deployments, pods, and replica sets in a given
-#    Kubernetes namespace using only 3 kubectl calls.
+#    Kubernetes namespace using a single kubectl call.
 #
 #  • For every service in predefined categories (oms, health,
 #    partner, occ, web):
@@ -22,6 +22,10 @@ set -euo pipefail
 #  • Caches common branch output per (repo + tag).
 #    - If the tag didn’t change, results load instantly.
 #    - Keeps last 3 historical tags for reference.
+#    - On a tag change, GitHub is asked with If-None-Match
+#      (ETag + body cached per URL), so unchanged branches come
+#      back as a bodyless 304 that doesn't count against the
+#      rate limit.
 #
 #  • Generates a clean HTML report with:
 #       - Service cards in grid layout
@@ -31,6 +35,8 @@ set -euo pipefail
 #       - History dropdown (last 3 tags)
 #
 #  • Saves output to:  ./report.html
+#    The report is not self-contained: history dropdowns load
+#    lazily from ./report_history/, so keep (or copy) both.
 #
 #
 #  HOW TO RUN
@@ -46,6 +52,26 @@ set -euo pipefail
 #
 #     If namespace omitted, default = "s2"
 #
+#     K8s objects are snapshotted for 60s, so quick re-runs skip
+#     kubectl. To bypass the snapshot, or change how long it lives:
+#        ./fetch_kube.sh s2 --force-refresh
+#        ./fetch_kube.sh s2 --k8s-ttl 300     (0 = never reuse)
+#
+#     To ignore every local cache (K8s snapshot, per-tag common
+#     branches) and check with the servers instead:
+#        ./fetch_kube.sh s2 --fresh
+#     GitHub results are still revalidated by ETag, so unchanged
+#     branch lists cost a 304, not a re-download.
+#
+#     Per-service progress goes to the log file only; to also
+#     see it on the terminal:
+#        DEBUG=1 ./fetch_kube.sh s2
+#
+#  3. Optional — read K8s through a running `kubectl proxy`
+#     (reuses its auth/connection instead of spawning kubectl):
+#        kubectl proxy --port=8001 &
+#        K8S_API=http://127.0.0.1:8001 ./fetch_kube.sh s2
+#
 #
 #  PREREQUISITES
 #  ------------------------------------------------------------
@@ -53,14 +79,17 @@ set -euo pipefail
 #  • kubectl configured to correct cluster
 #  • jq (for JSON parsing)
 #  • curl
-#  • bash
+#  • bash 4.4+ (macOS ships 3.2 → brew install bash)
 #
 #
 #  OUTPUT
 #  ------------------------------------------------------------
 #  - CLI logs written to ~/.k8s-deploy-cache/fetch_kube.log
 #  - HTML report saved to ./report.html
-#  - Cached tags and cached common branches stored under:
+#  - Per-card history sidecars saved to ./report_history/
+#    (next to the report; replaced only once a run succeeds)
+#  - Cached common branches and K8s snapshots
+#    stored under:
 #        ~/.k8s-deploy-cache/
 #
 # ============================================================
@@ -68,20 +97,98 @@ set -euo pipefail
 #############################################
 # CONFIG & DIRECTORIES
 #############################################
-NS="${1:-s2}"
+NS="s2"
+FORCE_REFRESH=""
+FRESH=""
+K8S_CACHE_TTL=60         # seconds a K8s snapshot is reused
+
+usage() {
+  echo "usage: $0 [namespace] [--force-refresh] [--fresh] [--k8s-ttl SECONDS]"
+}
+
+while (( $# )); do
+  case "$1" in
+    --force-refresh) FORCE_REFRESH=1 ;;
+    --fresh)         FRESH=1; FORCE_REFRESH=1 ;;
+    --k8s-ttl)       K8S_CACHE_TTL="${2:?--k8s-ttl needs seconds}"; shift ;;
+    --k8s-ttl=*)     K8S_CACHE_TTL="${1#*=}" ;;
+    -h|--help)       usage; exit 0 ;;
+    -*)              echo "unknown option: $1" >&2; usage >&2; exit 1 ;;
+    *)               NS="$1" ;;
+  esac
+  shift
+done
+if [[ ! "$K8S_CACHE_TTL" =~ ^[0-9]+$ ]]; then
+  echo "--k8s-ttl must be a whole number of seconds" >&2
+  exit 1
+fi
+
 PARALLEL=6
+K8S_API="${K8S_API:-}"   # e.g. http://127.0.0.1:8001 (kubectl proxy)
 
 CACHE_DIR="${HOME}/.k8s-deploy-cache"
 LOG_FILE="${CACHE_DIR}/fetch_kube.log"
 REPORT_FILE="./report.html"
+REPORT_HISTORY_DIR="${REPORT_FILE%/*}/report_history"
 
-TAG_CACHE_DIR="${CACHE_DIR}/tagcache"
 CB_CACHE_DIR="${CACHE_DIR}/common_branches"
+CB_LATEST_DIR="${CB_CACHE_DIR}/latest"
+ETAG_DIR="${CACHE_DIR}/etag"
+
+# keyed by where the objects come from too: the same namespace in
+# another kube context (or through K8S_API) is a different snapshot
+if [[ -n "$K8S_API" ]]; then
+  K8S_SOURCE="$K8S_API"
+else
+  K8S_SOURCE=$(kubectl config current-context 2>/dev/null) || K8S_SOURCE="none"
+fi
+K8S_SNAPSHOT="${CACHE_DIR}/k8s-snapshot-${K8S_SOURCE//[^A-Za-z0-9._-]/_}-${NS}.tsv"
+
+# GitHub throttling — shared by all parallel jobs via GH_BACKOFF_FILE
+GH_BACKOFF_FILE="${CACHE_DIR}/github_backoff_until"
+GH_MAX_RETRIES=3
+GH_MAX_BACKOFF=60        # seconds
+GH_LOW_REMAINING=50      # slow down below this many requests left
+
+# every GitHub call is its own curl process, so keep each handshake cheap:
+# HTTP/2 when offered, gzip bodies, and bounded waits. A curl built
+# without nghttp2 / zlib rejects those flags outright (hidden by -s,
+# every call would come back 000), so only pass what it supports
+GH_CURL_OPTS=(--connect-timeout 10 --max-time 30)
+curl_features=$(curl -V 2>/dev/null | sed -n 's/^Features: //p') || curl_features=""
+[[ " $curl_features " == *" HTTP2 "* ]] && GH_CURL_OPTS+=(--http2)
+[[ " $curl_features " == *" libz "* ]] && GH_CURL_OPTS+=(--compressed)
+
+mkdir -p "$CACHE_DIR" "$CB_CACHE_DIR" "$CB_LATEST_DIR" "$ETAG_DIR"
+
+# printf's own strftime → no `date` process, no tee pipeline per line
+log(){
+  local line
+  printf -v line '[%(%Y-%m-%d %H:%M:%S)T] %s' -1 "$*"
+  echo "$line"
+  echo "$line" >> "$LOG_FILE"
+}
 
-mkdir -p "$CACHE_DIR" "$TAG_CACHE_DIR" "$CB_CACHE_DIR"
+# per-service chatter: log file always, terminal only with DEBUG=1
+debug(){
+  if [[ -n "${DEBUG:-}" ]]; then
+    log "$@"
+  else
+    printf '[%(%Y-%m-%d %H:%M:%S)T] %s\n' -1 "$*" >> "$LOG_FILE"
+  fi
+}
 
-timestamp(){ date +"%Y-%m-%d %H:%M:%S"; }
-log(){ echo "[$(timestamp)] $*" | tee -a "$LOG_FILE"; }
+# modification time, epoch seconds (GNU / BSD stat)
+file_mtime() {
+  stat -c %Y "$1" 2>/dev/null || stat -f %m "$1"
+}
+
+# seconds since last modification
+file_age() {
+  local mtime
+  mtime=$(file_mtime "$1")
+  echo $(( $(date +%s) - mtime ))
+}
 
 #############################################
 # CATEGORY STRUCTURE / REPO MAP (MACOS SAFE)
@@ -123,24 +230,6 @@ declare -A CATEGORIES=(
 )
 
 
-#############################################
-# TAG CACHE HELPERS
-#############################################
-
-tag_cache_file(){ echo "${TAG_CACHE_DIR}/${1}.txt"; }
-
-read_tag_cache() {
-  local f
-  f=$(tag_cache_file "$1")
-  [[ -f "$f" ]] && cat "$f" || return 1
-}
-
-write_tag_cache() {
-  local svc="$1"
-  local tag="$2"
-  echo "$tag" > "$(tag_cache_file "$svc")"
-}
-
 #############################################
 # COMMON BRANCHES CACHE HELPERS
 #############################################
@@ -157,181 +246,641 @@ cb_write_cache() {
   local tmp="$3"
   cp "$tmp" "$(cb_cache_file "$repo" "$tag")"
 
-  # keep last 3 results only
-  ls -1t "${CB_CACHE_DIR}/${repo}-"*.txt 2>/dev/null \
-    | tail -n +4 \
-    | xargs -I{} rm -f "{}" 2>/dev/null || true
+  # keep the 4 most recently used results only: the current tag
+  # plus the 3 previous ones the history dropdown shows
+  local -a recent=()
+  cb_by_recency "$repo" recent
+  (( ${#recent[@]} <= 4 )) || rm -f "${recent[@]:4}"
+}
+
+# repo → other repos whose names start with "<repo>-"
+declare -A CB_LONGER_REPOS=()
+for _a in $(printf '%s\n' "${REPO_MAP[@]}" | sort -u); do
+  for _b in $(printf '%s\n' "${REPO_MAP[@]}" | sort -u); do
+    [[ "$_b" == "${_a}-"* ]] && CB_LONGER_REPOS[$_a]+="$_b "
+  done
+done
+unset _a _b
+
+# cb_by_recency <repo> <out_array>  → cache files, most recently used first
+#  glob + [[ -nt ]] (builtin stat) instead of an ls | tail | xargs pipeline;
+#  a repo only ever holds a handful of entries, so insertion order is fine
+cb_by_recency() {
+  local -n _sorted="$2"
+  local _f _i _r
+  _sorted=()
+  for _f in "${CB_CACHE_DIR}/${1}-"*.txt; do
+    [[ -e "$_f" ]] || continue
+    # "oms-*" also globs oms-web's entries
+    for _r in ${CB_LONGER_REPOS[$1]:-}; do
+      [[ "$_f" == "${CB_CACHE_DIR}/${_r}-"* ]] && continue 2
+    done
+    for (( _i = 0; _i < ${#_sorted[@]}; _i++ )); do
+      [[ "$_f" -nt "${_sorted[_i]}" ]] && break
+    done
+    _sorted=("${_sorted[@]:0:_i}" "$_f" "${_sorted[@]:_i}")
+  done
+}
+
+# atomic_write <dst>  (content on stdin)
+#  parallel jobs sharing a repo write the same cache files;
+#  a unique temp file + rename keeps readers from seeing partial data
+atomic_write() {
+  local tmp
+  tmp=$(mktemp "${1}.XXXXXX")
+  cat > "$tmp"
+  mv "$tmp" "$1"
+}
+
+# last rendered results per repo, reused when the branch list is a 304
+cb_latest_file() {
+  local repo="$1"
+  echo "${CB_LATEST_DIR}/${repo}.txt"
 }
 
 #############################################
-# BUILT-IN common_branches() USING GITHUB API
+# CONDITIONAL GITHUB GET (ETAG / 304)
 #############################################
 
-common_branches() {
-  local repo="$1"     # example: oms
-  local tag="$2"      # example: vs2-dec-18
+# header_value <headers_file> <name>  (case-insensitive, first match)
+header_value() {
+  awk -v k="$(echo "$2" | tr '[:upper:]' '[:lower:]')" '
+    { line=$0; sub(/\r$/, "", line) }
+    tolower(substr(line, 1, length(k) + 1)) == k ":" {
+      sub(/^[^:]*: */, "", line); print line; exit
+    }' "$1" 2>/dev/null
+}
 
-  local cache_file
-  cache_file=$(cb_cache_file "$repo" "$tag")
+# sleep until a rate-limit backoff set by any job has passed
+gh_wait_backoff() {
+  local resume_at now
+  resume_at=$(cat "$GH_BACKOFF_FILE" 2>/dev/null || echo 0)
+  now=$(date +%s)
+  if (( resume_at > now )); then
+    sleep $(( resume_at - now ))
+  fi
+}
 
-  # CACHE HIT → super fast
-  if [[ -f "$cache_file" ]]; then
-    cat "$cache_file"
-    return
+# seconds to back off after a 403/429, empty if not rate limited
+gh_retry_after() {
+  local headers="$1"
+  local wait_s reset
+  wait_s=$(header_value "$headers" retry-after)
+  if [[ -z "$wait_s" && "$(header_value "$headers" x-ratelimit-remaining)" == "0" ]]; then
+    reset=$(header_value "$headers" x-ratelimit-reset)
+    wait_s=$(( ${reset:-0} - $(date +%s) ))
   fi
+  [[ -n "$wait_s" ]] || return 0
+  [[ "$wait_s" =~ ^-?[0-9]+$ ]] || wait_s=$GH_MAX_BACKOFF
+  (( wait_s < 1 )) && wait_s=1
+  (( wait_s > GH_MAX_BACKOFF )) && wait_s=$GH_MAX_BACKOFF
+  echo "$wait_s"
+}
 
-  # CACHE MISS → fetch from GitHub API
-  local api="https://api.github.com/repos/Orange-Health/${repo}"
-  local auth=(-H "Authorization: Bearer $GITHUB_TOKEN")
+# cache prefix for a URL → <prefix>.etag + <prefix>.json
+etag_cache_file() {
+  local key="${1#https://api.github.com/}"
+  echo "${ETAG_DIR}/${key//[^A-Za-z0-9._-]/_}"
+}
+
+# gh_curl <body_out> <headers_out> <curl args…>  → prints HTTP status
+#  retries rate-limited responses, honoring the shared backoff
+gh_curl() {
+  local body="$1"
+  local headers="$2"
+  shift 2
+
+  local attempt status wait_s remaining limited
+  for (( attempt = 1; ; attempt++ )); do
+    gh_wait_backoff
+
+    status=$(curl -s "${GH_CURL_OPTS[@]}" \
+      -H "Authorization: Bearer $GITHUB_TOKEN" "$@" \
+      -D "$headers" -o "$body" -w '%{http_code}') || status="000"
+
+    # GraphQL reports its rate limit as a 200 with a RATE_LIMITED error
+    limited=""
+    if [[ "$status" == "403" || "$status" == "429" ]] \
+        || { [[ "$status" == "200" ]] && grep -q '"type": *"RATE_LIMITED"' "$body" 2>/dev/null; }; then
+      limited=1
+    fi
+
+    # out of quota (whatever the status) or rate limited →
+    # tell every job to hold off until the reset
+    wait_s=""
+    remaining=$(header_value "$headers" x-ratelimit-remaining)
+    if [[ -n "$limited" || "$remaining" == "0" ]]; then
+      wait_s=$(gh_retry_after "$headers")
+      [[ -z "$wait_s" ]] || echo $(( $(date +%s) + wait_s )) > "$GH_BACKOFF_FILE"
+    fi
 
-  tmpfile=$(mktemp)
+    [[ -n "$limited" && -n "$wait_s" ]] || break
+    (( attempt < GH_MAX_RETRIES )) || break
+    log "GitHub rate limited, retrying in ${wait_s}s: ${*: -1}" >&2
+  done
 
-  branches=$(curl -sf "${auth[@]}" "$api/branches?per_page=200" || echo "[]")
+  # close to the limit → space requests out
+  if [[ -n "$remaining" ]] && (( remaining < GH_LOW_REMAINING )); then
+    sleep 1
+  fi
 
-  echo "$branches" \
-    | jq -r '.[] | select(.name | ascii_downcase | contains("common")) | .name' \
-    | while read -r br; do
-        commit_json=$(curl -sf "${auth[@]}" "$api/commits/${br}" || echo "{}")
+  echo "$status"
+}
 
-        sha=$(echo "$commit_json" | jq -r '.sha // empty')
-        date=$(echo "$commit_json" | jq -r '.commit.committer.date // empty')
-        author=$(echo "$commit_json" | jq -r '.commit.committer.name // empty')
+# conditional_get <url> <body_out> <etag_out>  → prints HTTP status
+#  on 304 <body_out> is filled from the cached body; on 200 the new
+#  ETag goes to <etag_out> and is only cached once the caller has
+#  used the body successfully (etag_save)
+conditional_get() {
+  local url="$1"
+  local body="$2"
+  local etag_out="$3"
+  local cache headers status
+  cache=$(etag_cache_file "$url")
+  headers=$(mktemp)
+
+  local cond=()
+  if [[ -f "${cache}.etag" && -f "${cache}.json" ]]; then
+    cond=(-H "If-None-Match: $(cat "${cache}.etag")")
+  fi
 
-        [[ -z "$sha" || -z "$date" ]] && continue
+  status=$(gh_curl "$body" "$headers" "${cond[@]}" "$url")
 
-        # pretty date format
-        pretty=$(date -j -f "%Y-%m-%dT%H:%M:%SZ" "$date" "+%d %b %I:%M %p" 2>/dev/null || echo "$date")
+  case "$status" in
+    304)
+      cp "${cache}.json" "$body"
+      ;;
+    200)
+      header_value "$headers" etag > "$etag_out"
+      ;;
+  esac
 
-        printf "%-22s %-16s %-20s https://github.com/Orange-Health/%s/commit/%s\n" \
-          "$br" "$pretty" "$author" "$repo" "$sha"
-      done | tee "$tmpfile"
+  rm -f "$headers"
+  echo "$status"
+}
 
-  cb_write_cache "$repo" "$tag" "$tmpfile"
-  rm -f "$tmpfile"
+# etag_save <url> <body> <etag_file>  → cache a conditional_get 200
+etag_save() {
+  local cache etag
+  cache=$(etag_cache_file "$1")
+  etag=$(cat "$3" 2>/dev/null) || etag=""
+  [[ -n "$etag" ]] || return 0
+  atomic_write "${cache}.json" < "$2"
+  echo "$etag" | atomic_write "${cache}.etag"
 }
 
 #############################################
-# LOAD K8S JSON — ONLY 3 CALLS
+# BUILT-IN common_branches() USING GITHUB API
 #############################################
 
-log "Loading K8s objects (deployments, pods, rs)…"
+# HEAD commit of every "common" branch — one request instead of one per branch
+BRANCH_HEADS_QUERY='
+query($repo: String!) {
+  repository(owner: "Orange-Health", name: $repo) {
+    refs(refPrefix: "refs/heads/", query: "common", first: 100) {
+      nodes {
+        name
+        target { ... on Commit { oid committedDate committer { name } } }
+      }
+    }
+  }
+}'
+
+# branch_heads <repo> <body_out>  → prints HTTP status
+#  GraphQL answers 200 even when it fails (rate limited, repo missing
+#  or not visible) and says so in .errors; that counts as "000" here,
+#  so callers never cache or ETag-pin an empty branch list
+branch_heads() {
+  local repo="$1"
+  local body="$2"
+  local headers payload status
+  headers=$(mktemp)
+  payload=$(mktemp)
+
+  # from a file, not stdin: gh_curl may have to send it more than once
+  jq -n --arg q "$BRANCH_HEADS_QUERY" --arg repo "$repo" \
+    '{query: $q, variables: {repo: $repo}}' > "$payload"
+  status=$(gh_curl "$body" "$headers" -X POST --data-binary "@${payload}" "https://api.github.com/graphql")
+  if [[ "$status" == "200" ]] \
+      && ! jq -e '.data.repository.refs and (.errors | not)' "$body" >/dev/null 2>&1; then
+    log "GitHub GraphQL error for ${repo}: $(jq -c '.errors // "no repository"' "$body" 2>/dev/null)" >&2
+    status="000"
+  fi
+
+  rm -f "$headers" "$payload"
+  echo "$status"
+}
+
+# common_branches <repo> <tag>...  → one cb_result_file per tag
+#  the result depends on the repo only (tags just key the cache), so
+#  every tag of a repo shares one GitHub round trip and one connection
+common_branches() {
+  local repo="$1"     # example: oms
+  shift               # example: vs2-dec-18 vs2-dec-19
+
+  local tag cache_file
+  local -a missing=()
+  for tag in "$@"; do
+    cache_file=$(cb_cache_file "$repo" "$tag")
+
+    # CACHE HIT → super fast (unless --fresh asked to revalidate)
+    #  touch so the mtime-ordered prune in cb_write_cache is LRU
+    if [[ -z "$FRESH" && -f "$cache_file" ]]; then
+      cp "$cache_file" "$(cb_result_file "$repo" "$tag")"
+      touch "$cache_file"
+    else
+      missing+=("$tag")
+    fi
+  done
+  (( ${#missing[@]} > 0 )) || return 0
+
+  # CACHE MISS → revalidate against GitHub API
+  #  the ETag'd branch list is a free change check (304);
+  #  only when it changed are the HEAD commits queried
+  local api="https://api.github.com/repos/Orange-Health/${repo}"
+  local branches_url="$api/branches?per_page=200"
+  local latest work status heads_status="200"
+  latest=$(cb_latest_file "$repo")
+  work=$(mktemp -d)
+
+  status=$(conditional_get "$branches_url" "$work/branches" "$work/etag")
+
+  if [[ "$status" == "304" && -f "$latest" ]]; then
+    # branch list (incl. HEAD shas) unchanged → reuse last results
+    cp "$latest" "$work/out"
+  else
+    heads_status=$(branch_heads "$repo" "$work/heads")
+    [[ "$heads_status" == "200" ]] || echo "{}" > "$work/heads"
+
+    jq -r '
+      .data.repository.refs.nodes[]?
+      | select(.name | ascii_downcase | contains("common"))
+      | select(.target.oid and .target.committedDate)
+      | [ .name,
+          .target.oid,
+          # pretty date format, parsed in jq — no `date` fork per branch
+          (.target.committedDate as $d
+           | try ($d | fromdateiso8601 | strftime("%d %b %I:%M %p")) catch $d),
+          (.target.committer.name // "") ]
+      | @tsv' "$work/heads" \
+      | while IFS=$'\t' read -r br sha pretty author; do
+          printf "%-22s %-16s %-20s https://github.com/Orange-Health/%s/commit/%s\n" \
+            "$br" "$pretty" "$author" "$repo" "$sha"
+        done > "$work/out"
+
+    # the branch list's ETag is only kept together with the heads it
+    # describes: a 304 later must never stand in for heads not fetched
+    if [[ "$heads_status" == "200" ]]; then
+      atomic_write "$latest" < "$work/out"
+      [[ "$status" == "200" ]] && etag_save "$branches_url" "$work/branches" "$work/etag"
+    fi
+  fi
 
-DEPLOY_JSON=$(kubectl -n "$NS" get deployments -o json)
-POD_JSON=$(kubectl -n "$NS" get pods -o json)
-RS_JSON=$(kubectl -n "$NS" get rs -o json)
+  # a failed heads query is still shown for this run, but never
+  # cached: later runs would take the empty list as a hit
+  for tag in "${missing[@]}"; do
+    cp "$work/out" "$(cb_result_file "$repo" "$tag")"
+    [[ "$heads_status" == "200" ]] && cb_write_cache "$repo" "$tag" "$work/out"
+  done
+  rm -rf "$work"
+}
+
+#############################################
+# LOAD K8S OBJECTS — ONE CALL, ONLY THE FIELDS USED
+#############################################
+
+# one tab-separated line per object; every kind shares the layout and
+# leaves the fields it doesn't have empty:
+#   kind  name  owner  pod-label  template-image  pod-image  restartedAt
+#   creationTimestamp  replicas  available  startTime  ready  restarts
+#   state (JSON object)
+K8S_FIELDS_JSONPATH='{range .items[*]}'\
+'{.kind}{"\t"}{.metadata.name}{"\t"}{.metadata.ownerReferences[0].name}{"\t"}'\
+'{.metadata.labels.pod}{"\t"}{.spec.template.spec.containers[0].image}{"\t"}'\
+'{.spec.containers[0].image}{"\t"}'\
+'{.spec.template.metadata.annotations.kubectl\.kubernetes\.io/restartedAt}{"\t"}'\
+'{.metadata.creationTimestamp}{"\t"}{.spec.replicas}{"\t"}{.status.availableReplicas}{"\t"}'\
+'{.status.startTime}{"\t"}{.status.containerStatuses[0].ready}{"\t"}'\
+'{.status.containerStatuses[0].restartCount}{"\t"}{.status.containerStatuses[0].state}'\
+'{"\n"}{end}'
+
+if [[ -z "$FORCE_REFRESH" && -f "$K8S_SNAPSHOT" ]] \
+    && (( $(file_age "$K8S_SNAPSHOT") < K8S_CACHE_TTL )); then
+  log "Using K8s snapshot (< ${K8S_CACHE_TTL}s old, --force-refresh to reload)…"
+else
+  log "Loading K8s objects (deployments, pods, rs)…"
+
+  k8s_dir=$(mktemp -d)
+
+  if [[ -n "$K8S_API" ]]; then
+    # through kubectl proxy: one curl, the three lists fetched in parallel.
+    # Same line layout as the jsonpath above; API lists (DeploymentList, …)
+    # leave `kind` off their items, so it is taken from the list.
+    curl -sf --no-progress-meter --parallel \
+      "${K8S_API}/apis/apps/v1/namespaces/${NS}/deployments" -o "$k8s_dir/deploy.json" \
+      "${K8S_API}/api/v1/namespaces/${NS}/pods" -o "$k8s_dir/pod.json" \
+      "${K8S_API}/apis/apps/v1/namespaces/${NS}/replicasets" -o "$k8s_dir/rs.json"
+    jq -r -n '
+      inputs | (.kind | rtrimstr("List")) as $list_kind | .items[]
+      | [ (.kind // $list_kind),
+          .metadata.name,
+          .metadata.ownerReferences[0].name,
+          .metadata.labels.pod,
+          .spec.template.spec.containers[0].image,
+          .spec.containers[0].image,
+          .spec.template.metadata.annotations["kubectl.kubernetes.io/restartedAt"],
+          .metadata.creationTimestamp,
+          .spec.replicas,
+          .status.availableReplicas,
+          .status.startTime,
+          .status.containerStatuses[0].ready,
+          .status.containerStatuses[0].restartCount,
+          (.status.containerStatuses[0].state | if . then tojson else null end) ]
+      | map(if . == null then "" else tostring end) | join("\t")' \
+      "$k8s_dir/deploy.json" "$k8s_dir/pod.json" "$k8s_dir/rs.json" \
+      > "$k8s_dir/snapshot.tsv"
+  else
+    # one kubectl process / auth round-trip for all three kinds.
+    # kubectl projects the fields itself, so the multi-MB JSON is
+    # never handed to jq — only a few short lines per object are
+    kubectl -n "$NS" get deploy,pod,rs -o jsonpath="$K8S_FIELDS_JSONPATH" \
+      > "$k8s_dir/snapshot.tsv"
+  fi
+
+  atomic_write "$K8S_SNAPSHOT" < "$k8s_dir/snapshot.tsv"
+  rm -rf "$k8s_dir"
+fi
+
+#############################################
+# NAME INDEXES — ONE jq PASS OVER THE SNAPSHOT
+#  pods go to the longest matching service-name
+#  prefix, falling back to the `pod` label
+#############################################
+
+declare -A DEPLOY_INFO=()           # deployment → image, deployed_at, replicas, available
+declare -A RS_IMAGE_BY_OWNER=()     # owning deployment → image
+declare -A POD_IMAGE_BY_LABEL=()    # `pod` label → image
+declare -A POD_IMAGE_BY_SERVICE=()  # service (prefix/label match) → image
+declare -A POD_INFO_BY_NAME=()      # pod → pod_info fields (tsv)
+declare -A PODS_BY_SERVICE=()       # service → pod names, one per line
+
+# one \x1f separated record per object (so empty fields survive `read`),
+# led by its kind:
+#   D name image deployed_at replicas available
+#   R owner image
+#   P name svc label image pod_info-tsv
+while IFS=$'\x1f' read -r kind f1 f2 f3 f4 f5 f6; do
+  case "$kind" in
+    D)
+      DEPLOY_INFO[$f1]="${f2}"$'\x1f'"${f3}"$'\x1f'"${f4}"$'\x1f'"${f5}"$'\x1f'"${f6}"
+      ;;
+    R)
+      [[ -n "${RS_IMAGE_BY_OWNER[$f1]:-}" ]] || RS_IMAGE_BY_OWNER[$f1]="$f2"
+      ;;
+    P)
+      POD_INFO_BY_NAME[$f1]="$f5"
+      if [[ -n "$f3" && -n "$f4" && -z "${POD_IMAGE_BY_LABEL[$f3]:-}" ]]; then
+        POD_IMAGE_BY_LABEL[$f3]="$f4"
+      fi
+      if [[ -n "$f2" ]]; then
+        PODS_BY_SERVICE[$f2]+="${f1}"$'\n'
+        if [[ -n "$f4" && -z "${POD_IMAGE_BY_SERVICE[$f2]:-}" ]]; then
+          POD_IMAGE_BY_SERVICE[$f2]="$f4"
+        fi
+      fi
+      ;;
+  esac
+done < <(
+  jq -R -r -n --arg svcs "${CATEGORIES[*]}" '
+    # empty snapshot field → fallback
+    def orelse($v): if . == "" then $v else . end;
+
+    # service names as a set, plus their distinct lengths (longest
+    # first). a pod whose `pod` label names a service belongs to it;
+    # otherwise its name is sliced to each length and the slice looked
+    # up, so oms-api-worker-* can never land on oms-api
+    ($svcs | split(" ") | map(select(length > 0))) as $names
+    | (reduce $names[] as $s ({}; .[$s] = true)) as $known
+    | ($names | map(length) | unique | reverse) as $lengths
+
+    | inputs | split("\t")
+    | { kind: .[0], name: .[1], owner: .[2], label: .[3], tmpl_image: .[4],
+        pod_image: .[5], restarted: .[6], created: .[7], replicas: .[8],
+        available: .[9], start: .[10], ready: .[11], restarts: .[12],
+        state: (.[13] // "") }
+
+    | if .kind == "Deployment" then
+        (first(.restarted, .created, "N/A" | select(. != ""))) as $deployed
+        | [ "D", .name, .tmpl_image, $deployed,
+            (.replicas | orelse("0")), (.available | orelse("0")) ]
+
+      elif .kind == "ReplicaSet" then
+        select(.owner != "" and .tmpl_image != "")
+        | [ "R", .owner, .tmpl_image ]
+
+      elif .kind == "Pod" then
+        .name as $name
+        | ( (.label | select($known[.]))
+            // first($lengths[] as $n | $name[0:$n] | select($known[.]))
+            // "" ) as $svc
+        | (try (.state | fromjson | keys[0]) catch "") as $state
+        | [ "P", $name, $svc, .label, .pod_image,
+            ([ $name,
+               (.start | orelse("null")),
+               (.ready | orelse("null")),
+               (.restarts | orelse("null")),
+               (if $state == "running" then "Running"
+                elif $state == "waiting" then "Waiting"
+                elif $state == "terminated" then "Terminated"
+                else "Unknown" end)
+             ] | @tsv) ]
+
+      else empty end
+
+    | map(tostring) | join("\u001f")' "$K8S_SNAPSHOT"
+)
+
+# deploy_info <svc> → sets dep_image, deployed_at, replicas, available
+deploy_info() {
+  IFS=$'\x1f' read -r dep_image deployed_at replicas available \
+    <<< "${DEPLOY_INFO[$1]:-}"
+}
 
 #############################################
 # IMAGE / TAG RESOLUTION (MACOS SAFE)
 #############################################
 
+# resolve_image <svc> <out_var>  — result via printf -v, no subshell
 resolve_image() {
   local svc="$1"
-  local img=""
+  local _out="$2"
+  local _img=""
 
   # Deployment
-  img=$(echo "$DEPLOY_JSON" \
-    | jq -r --arg s "$svc" '
-        .items[] | select(.metadata.name==$s)
-        | .spec.template.spec.containers[0].image // empty')
-  [[ -n "$img" ]] && { echo "$img"; return; }
+  local dep_image deployed_at replicas available
+  deploy_info "$svc"
+  _img="$dep_image"
 
   # ReplicaSet
-  img=$(echo "$RS_JSON" \
-    | jq -r --arg s "$svc" '
-        .items[]
-        | select(.metadata.ownerReferences[0].name==$s)
-        | .spec.template.spec.containers[0].image // empty')
-  [[ -n "$img" ]] && { echo "$img"; return; }
+  [[ -n "$_img" ]] || _img="${RS_IMAGE_BY_OWNER[$svc]:-}"
 
   # Pod by label
-  img=$(echo "$POD_JSON" \
-    | jq -r --arg s "$svc" '
-        .items[] | select(.metadata.labels.pod==$s)
-        | .spec.containers[0].image // empty')
-  [[ -n "$img" ]] && { echo "$img"; return; }
-
-  # Pod by prefix
-  img=$(echo "$POD_JSON" \
-    | jq -r --arg s "$svc" '
-        .items[] | select(.metadata.name|startswith($s))
-        | .spec.containers[0].image // empty')
-  [[ -n "$img" ]] && { echo "$img"; return; }
-
-  echo ""
+  [[ -n "$_img" ]] || _img="${POD_IMAGE_BY_LABEL[$svc]:-}"
+
+  # Pod by prefix (pods were assigned to services in the index pass)
+  [[ -n "$_img" ]] || _img="${POD_IMAGE_BY_SERVICE[$svc]:-}"
+
+  printf -v "$_out" '%s' "$_img"
 }
 
+# extract_tag <image> <out_var>
 extract_tag() {
-  local img="$1"
-  [[ -z "$img" ]] && { echo "<none>"; return; }
-  [[ "$img" == *"@"* ]] && { echo "<none>"; return; }
-  [[ "$img" == *":"* ]] && { echo "${img##*:}"; return; }
-  echo "<none>"
+  local _img="$1"
+  local _out="$2"
+  local _tag="<none>"
+  if [[ -n "$_img" && "$_img" != *"@"* && "$_img" == *":"* ]]; then
+    _tag="${_img##*:}"
+  fi
+  printf -v "$_out" '%s' "$_tag"
+}
+
+#############################################
+# HTML RENDER HELPERS
+#############################################
+
+# html_escape <string> <out_var>  (parameter expansion, no subshell)
+html_escape() {
+  local _s="$1"
+  _s=${_s//&/'&amp;'}
+  _s=${_s//</'&lt;'}
+  _s=${_s//>/'&gt;'}
+  _s=${_s//\'/'&#39;'}
+  printf -v "$2" '%s' "$_s"
 }
 
+# card header, built once; filled per service with printf -v.
+# args: svc, repo, tag, status class, status, deployed_at
+CARD_HEAD_FMT="<div class='card'>
+<div class='svc-title'>%s</div>
+<div><b>Repo:</b> %s</div>
+<div><b>Tag:</b> %s</div>
+<div class='status-row'>
+<span class='status %s'>%s</span>
+<span class='deployed'>Deployed: %s</span>
+</div>"
+
 #############################################
 # POD INFO HELPER
 #############################################
 
-pod_info() {
-  local pod="$1"
-  echo "$POD_JSON" \
-    | jq -r --arg p "$pod" '
-        .items[] | select(.metadata.name==$p) |
-        {
-          name:.metadata.name,
-          start:.status.startTime,
-          restarts:(.status.containerStatuses[0].restartCount),
-          ready:(.status.containerStatuses[0].ready),
-          state:(if .status.containerStatuses[0].state.running then "Running"
-                 elif .status.containerStatuses[0].state.waiting then "Waiting"
-                 elif .status.containerStatuses[0].state.terminated then "Terminated"
-                 else "Unknown" end)
-        }
-        | "\(.name) | \(.start) | ready:\(.ready) restarts:\(.restarts) | \(.state)"'
+# raw fields, tab separated: name, start, ready, restarts, state
+# pod_line <pod> <out_var>  (no pipeline, no subshell)
+pod_line() {
+  local _name _start _ready _restarts _state
+  IFS=$'\t' read -r _name _start _ready _restarts _state <<< "${POD_INFO_BY_NAME[$1]:-}"
+  printf -v "$2" '%s | %s | ready:%s restarts:%s | %s' \
+    "$_name" "$_start" "$_ready" "$_restarts" "$_state"
 }
 
 
 #############################################
-# PROCESS A SINGLE SERVICE → HTML FRAGMENT
+# HISTORY SIDECAR (LAST 3)
+#  current tag is already rendered in the card → not repeated here
+#############################################
+
+# render pass only (all lookups done): a repo's cache listing and
+# bodies are read once, however many of its services / tags render
+declare -A CB_RECENT_MEMO=()   # repo → cache files, most recent first (\n-joined)
+declare -A CB_BODY_MEMO=()     # cache file → contents
+
+write_history() {
+  local repo="$1"
+  local tag="$2"
+  local out="$3"
+  local current_cb tmp
+  current_cb=$(cb_cache_file "$repo" "$tag")
+  tmp=$(mktemp)
+
+  local -a recent=()
+  if [[ -n "${CB_RECENT_MEMO[$repo]+set}" ]]; then
+    [[ -z "${CB_RECENT_MEMO[$repo]}" ]] || mapfile -t recent <<< "${CB_RECENT_MEMO[$repo]}"
+  else
+    cb_by_recency "$repo" recent
+    local IFS=$'\n'
+    CB_RECENT_MEMO[$repo]="${recent[*]}"
+    unset IFS
+  fi
+
+  # up to 3 entries besides the current tag
+  local h shown=0
+  for h in "${recent[@]}"; do
+    (( shown < 3 )) || break
+    [[ "$h" == "$current_cb" ]] && continue
+    if [[ -z "${CB_BODY_MEMO[$h]+set}" ]]; then
+      CB_BODY_MEMO[$h]=$(cat "$h" 2>/dev/null) || continue
+    fi
+    (( ++shown ))
+    echo "--- ${h##*/} ---"
+    echo "${CB_BODY_MEMO[$h]}"
+    echo
+  done > "$tmp"
+
+  mv "$tmp" "$out"
+}
+
+#############################################
+# PER-SERVICE PASSES
+#  1. local  — tag per service, from the in-memory indexes
+#  2. remote — common_branches once per repo, for all its tags,
+#              the only I/O wait, so the only parallel part
+#  3. render — one HTML fragment per service
 #############################################
 
 TMPDIR=$(mktemp -d)
+mkdir -p "$TMPDIR/cb"
 
-process_service() {
-  local svc="$1"
-  local frag="$TMPDIR/${svc}.html"
+# sidecars are built here and only replace the previous run's
+# REPORT_HISTORY_DIR once the new report has been written
+HISTORY_BUILD_DIR="$TMPDIR/report_history"
+mkdir -p "$HISTORY_BUILD_DIR"
 
-  log "Processing $svc …"
+declare -A SVC_TAG=()       # service → image tag, or <none>
+declare -A CB_LOOKUPS=()    # repo → its distinct tags, space separated
 
-  # macOS-safe associative array lookup
+# local_service <svc>  → fills SVC_TAG / CB_LOOKUPS
+local_service() {
+  local svc="$1"
   local repo="${REPO_MAP[$svc]:-unknown}"
 
-  # TAG — from cache or fresh
-  local tag=""
-  if tag_cached=$(read_tag_cache "$svc" 2>/dev/null); then
-    tag="$tag_cached"
-  else
-    local img
-    img=$(resolve_image "$svc")
-    tag=$(extract_tag "$img")
-    write_tag_cache "$svc" "$tag"
+  # straight from the in-memory indexes: a lookup, so there is no
+  # tag cache to go stale when a rollout only swaps the image
+  local img tag
+  resolve_image "$svc" img
+  extract_tag "$img" tag
+
+  SVC_TAG[$svc]="$tag"
+  if [[ "$tag" != "<none>" ]]; then
+    [[ " ${CB_LOOKUPS[$repo]:-} " == *" $tag "* ]] || CB_LOOKUPS[$repo]+="$tag "
   fi
+}
 
-  # DEPLOY TIME
-  local deployed_at
-  deployed_at=$(
-    echo "$DEPLOY_JSON" \
-      | jq -r --arg s "$svc" '
-          .items[] | select(.metadata.name==$s)
-          | (.spec.template.metadata.annotations["kubectl.kubernetes.io/restartedAt"]
-             // .metadata.creationTimestamp
-             // "N/A")'
-  )
+# where the remote pass leaves a lookup's output for the render pass
+cb_result_file() { echo "$TMPDIR/cb/${1}-${2}.txt"; }
+
+# render_service <svc>  → $TMPDIR/<svc>.html
+render_service() {
+  local svc="$1"
+  local frag="$TMPDIR/${svc}.html"
+
+  debug "Rendering $svc …"
+
+  # macOS-safe associative array lookup
+  local repo="${REPO_MAP[$svc]:-unknown}"
+  local tag="${SVC_TAG[$svc]}"
 
-  # STATUS (replicas)
-  local replicas available
-  replicas=$(echo "$DEPLOY_JSON" | jq -r --arg s "$svc" '.items[] | select(.metadata.name==$s) | .spec.replicas // 0')
-  available=$(echo "$DEPLOY_JSON" | jq -r --arg s "$svc" '.items[] | select(.metadata.name==$s) | .status.availableReplicas // 0')
+  # DEPLOY TIME + STATUS (replicas) — one lookup
+  local dep_image deployed_at replicas available
+  deploy_info "$svc"
 
   local status="avail:${available}/${replicas}"
   local status_class="status-degraded"
@@ -343,92 +892,128 @@ process_service() {
   fi
 
   # PODS
-  podlist=$(
-    echo "$POD_JSON" \
-      | jq -r --arg s "$svc" '
-          .items[]
-          | select(.metadata.labels.pod==$s or .metadata.name|startswith($s))
-          | .metadata.name'
-  )
+  local podlist="${PODS_BY_SERVICE[$svc]:-}"
 
   #############################################
   # BUILD HTML FRAGMENT
+  #  lines are collected in an array and written once
   #############################################
-  {
-    echo "<div class='card'>"
-    echo "<div class='svc-title'>$svc</div>"
-    echo "<div><b>Repo:</b> $repo</div>"
-    echo "<div><b>Tag:</b> $tag</div>"
-
-    echo "<div class='status-row'>"
-    echo "<span class='status $status_class'>$status</span>"
-    echo "<span class='deployed'>Deployed: $deployed_at</span>"
-    echo "</div>"
-
-    #############################################
-    # PODS DROPDOWN
-    #############################################
-    echo "<details><summary>Pods</summary><pre>"
-    if [[ -z "$podlist" ]]; then
-      echo "No pods found"
-    else
-      while read -r p; do
-        [[ -z "$p" ]] && continue
-        pod_info "$p"
-      done <<< "$podlist"
-    fi
-    echo "</pre></details>"
-
-    #############################################
-    # COMMON BRANCHES (CURRENT)
-    #############################################
-    echo "<details open><summary>common_branches (current)</summary><pre>"
-    if [[ "$tag" == "<none>" ]]; then
-      echo "Skipped (no tag)"
-    else
-      common_branches "$repo" "$tag"
+  local tag_html deployed_html card_head
+  html_escape "$tag" tag_html
+  html_escape "$deployed_at" deployed_html
+  printf -v card_head "$CARD_HEAD_FMT" \
+    "$svc" "$repo" "$tag_html" "$status_class" "$status" "$deployed_html"
+  local -a html=("$card_head")
+
+  #############################################
+  # PODS DROPDOWN
+  #############################################
+  html+=("<details><summary>Pods</summary><pre>")
+  if [[ -z "$podlist" ]]; then
+    html+=("No pods found")
+  else
+    local p line
+    while read -r p; do
+      [[ -z "$p" ]] && continue
+      pod_line "$p" line
+      html_escape "$line" line
+      html+=("$line")
+    done <<< "$podlist"
+  fi
+  html+=("</pre></details>")
+
+  #############################################
+  # COMMON BRANCHES (CURRENT)
+  #############################################
+  html+=("<details open><summary>common_branches (current)</summary><pre>")
+  if [[ "$tag" == "<none>" ]]; then
+    html+=("Skipped (no tag)")
+  else
+    local cb_out
+    cb_out=$(cb_result_file "$repo" "$tag")
+    if [[ -s "$cb_out" ]]; then
+      local cb_html
+      html_escape "$(< "$cb_out")" cb_html
+      html+=("$cb_html")
     fi
-    echo "</pre></details>"
-
-    #############################################
-    # COMMON BRANCHES HISTORY (LAST 3)
-    #############################################
-    echo "<details><summary>History (last 3)</summary><pre>"
-    ls -1t "${CB_CACHE_DIR}/${repo}-"*.txt 2>/dev/null \
-      | head -n 3 \
-      | while read -r h; do
-          echo "--- ${h##*/} ---"
-          cat "$h"
-          echo
-        done
-    echo "</pre></details>"
-
-    echo "</div>"
-  } > "$frag"
+  fi
+  html+=("</pre></details>")
+
+  #############################################
+  # COMMON BRANCHES HISTORY (LAST 3)
+  #  sidecar file, only fetched when the dropdown opens
+  #############################################
+  local hist_name="${repo}.txt"
+  [[ "$tag" != "<none>" ]] && hist_name="${repo}-${tag}.txt"
+  [[ -f "${HISTORY_BUILD_DIR}/${hist_name}" ]] \
+    || write_history "$repo" "$tag" "${HISTORY_BUILD_DIR}/${hist_name}"
+
+  html+=(
+    "<details><summary>History (last 3)</summary>"
+    "<iframe class='history' loading='lazy' src='${REPORT_HISTORY_DIR##*/}/${hist_name}'></iframe>"
+    "</details>"
+    "</div>"
+  )
+
+  printf '%s\n' "${html[@]}" > "$frag"
 }
 
 #############################################
-# PARALLEL EXECUTION
+# RUN THE PASSES
 #############################################
 
+# one flat work list, built up front
+ALL_SERVICES=()
 for cat in "${!CATEGORIES[@]}"; do
-  log "Category: $cat"
+  ALL_SERVICES+=(${CATEGORIES[$cat]})
+done
+log "Processing ${#ALL_SERVICES[@]} services (${!CATEGORIES[*]})…"
 
-  for svc in ${CATEGORIES[$cat]}; do
-    process_service "$svc" &
-    while (( $(jobs -r | wc -l) >= PARALLEL )); do
-      sleep 0.05
-    done
-  done
+for svc in "${ALL_SERVICES[@]}"; do
+  local_service "$svc"
+done
+
+# one lookup per repo, however many services / tags it has.
+# at most PARALLEL in flight; a new one starts as soon as any finishes
+log "Looking up common branches for ${#CB_LOOKUPS[@]} repos…"
+
+# one self-overwriting progress line, terminal only
+lookups_done=0
+lookup_finished() {
+  wait -n || true
+  (( ++lookups_done ))
+  if [[ -t 1 ]]; then
+    printf '\r  common_branches %d/%d done' "$lookups_done" "${#CB_LOOKUPS[@]}"
+  fi
+}
+
+running=0
+for repo in "${!CB_LOOKUPS[@]}"; do
+  if (( running >= PARALLEL )); then
+    lookup_finished
+    (( running-- ))
+  fi
+  # unquoted on purpose: one argument per tag
+  common_branches "$repo" ${CB_LOOKUPS[$repo]} &
+  (( ++running ))
+done
+
+while (( running > 0 )); do
+  lookup_finished
+  (( running-- )) || true
 done
+[[ -t 1 && ${#CB_LOOKUPS[@]} -gt 0 ]] && echo
 
-wait
+for svc in "${ALL_SERVICES[@]}"; do
+  render_service "$svc"
+done
 
 #############################################
 # BUILD FINAL HTML REPORT
 #############################################
 
-cat > "$REPORT_FILE" <<'EOF'
+{
+  cat <<'EOF'
 <!doctype html>
 <html><head>
 <meta charset="utf-8">
@@ -444,18 +1029,21 @@ body{font-family:-apple-system;background:#f5f6fa;margin:20px;}
 .status-missing{background:#ffd4d4;color:#a40000;}
 pre{background:#0b1220;color:#e7eef8;padding:10px;border-radius:8px;font-size:12px;white-space:pre-wrap;}
 .summary{cursor:pointer;}
+.history{width:100%;height:180px;border:0;border-radius:8px;background:#fff;}
 </style>
 </head><body>
 <h2>K8s Deployment Report</h2>
 <div class="grid">
 EOF
-
-cat "$TMPDIR"/*.html >> "$REPORT_FILE"
-
-cat >> "$REPORT_FILE" <<'EOF'
+  cat "$TMPDIR"/*.html
+  cat <<'EOF'
 </div>
 </body></html>
 EOF
+} > "$REPORT_FILE"
+
+rm -rf "$REPORT_HISTORY_DIR"
+mv "$HISTORY_BUILD_DIR" "$REPORT_HISTORY_DIR"
 
 log "Report generated → $REPORT_FILE"
 echo "Open report with: open $REPORT_FILE"